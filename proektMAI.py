@@ -1,14 +1,30 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Date, Boolean
+from sqlalchemy import create_engine, event, Column, Integer, String, ForeignKey, Date, Boolean, func, select, update, bindparam
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-import xml.etree.ElementTree as ET
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
 import logging
 import os
 import requests
 import zipfile
+import shutil
+import tempfile
 import hashlib
 import json 
+import re
+import sys
+import queue
+import threading
+
+""" lxml разбирает XML заметно быстрее и умеет фильтровать теги на уровне C; стандартный модуль используется, если lxml не установлен """
+try:
+    from lxml import etree as ET
+    LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    LXML = False
 
 """ Настройка логгирования """
 logging.basicConfig(
@@ -22,7 +38,10 @@ CONFIG = {
     'data_url': 'https://islod.obrnadzor.gov.ru/accredreestr/opendata/',
     'cache_dir': 'cache',
     'state_file': 'state.json',
-    'db_file': 'education.db'
+    'db_file': 'education.db',
+    'batch_size': 10_000,  # Сколько строк копить в памяти перед записью в БД
+    'threaded': True,  # Писать в БД в отдельном потоке, пока основной разбирает XML
+    'queue_size': 4  # Сколько готовых пачек может ждать записи
 }
 
 
@@ -104,7 +123,7 @@ class EducationLevel(Base):
     
     id = Column(Integer, primary_key=True)
     name = Column(String)  # 'Бакалавриат', 'Магистратура'
-    code = Column(String)  # 'bachelor', 'master'
+    code = Column(String, unique=True)  # 'bachelor', 'master'
     
 class EducationForm(Base):
     """Формы обучения (очная, заочная)"""
@@ -112,86 +131,190 @@ class EducationForm(Base):
     
     id = Column(Integer, primary_key=True)
     name = Column(String)  # 'Очная', 'Заочная'
-    code = Column(String)  # 'full_time', 'part_time'
+    code = Column(String, unique=True)  # 'full_time', 'part_time'
+
+""" Настройки SQLite для массовой загрузки: WAL без fsync на каждую транзакцию и большой кэш страниц """
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-262144',  # 256 MiB
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456'
+)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ Применяет SQLITE_PRAGMAS к каждому новому соединению """
+    """ Драйвер sqlite3 не должен сам открывать транзакции, ими управляет begin_sqlite_transaction """
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+def begin_sqlite_transaction(conn):
+    """ Явный BEGIN в начале каждой транзакции SQLAlchemy """
+    conn.exec_driver_sql('BEGIN')
+
+class LocalTagNames(dict):
+    """ Кэш {тег из XML: имя тега без пространства имён}. Имена интернируются, поэтому поиск
+        по строковым литералам в children_by_tag сводится к сравнению ссылок """
+    def __missing__(self, tag):
+        name = self[tag] = sys.intern(tag.rpartition('}')[2])
+        return name
+
+LOCAL_TAGS = LocalTagNames()
+
+def children_by_tag(elem):
+    """ Собирает дочерние элементы в словарь по имени тега за один проход (префикс пространства имён отбрасывается) """
+    local_tags = LOCAL_TAGS
+    return {local_tags[child.tag]: child for child in elem}
+
+""" Справочные поля (регион, округ, форма, тип, уровень) принимают лишь сотни разных значений на миллионы строк.
+    shared возвращает уже встречавшийся экземпляр строки, чтобы в памяти хранилась одна копия каждого значения """
+SHARED_STRINGS = {}
+
+def shared(text):
+    return SHARED_STRINGS.setdefault(text, text)
 
 def safe_text(element, default=''):
     """Гарантированно возвращает строку, даже если элемент или его текст отсутствуют"""
-    if element is not None and element.text is not None:
-        return element.text.strip()
-    return default  
+    if element is None:
+        return default
+    text = element.text
+    if text is None:
+        return default
+    return text.strip()
+
+""" Форматы для strptime, если не справился datetime.fromisoformat (например, даты без ведущих нулей: 2020-1-2) """
+DATE_FALLBACK_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%Y/%m/%d', '%Y-%m-%d %H:%M:%S')
 
-def safe_date(element, fmts=('%Y-%m-%d', '%d.%m.%Y', '%Y/%m/%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S%z')):
+def safe_date(element, fmts=DATE_FALLBACK_FORMATS):
     if element is None or element.text is None:
         return None
     text = element.text.strip()
     """ Удаляем временную зону если она есть """
     if '+' in text:
-        text = text.split('+')[0].strip()
+        text = text.partition('+')[0].rstrip()
+    """ Основной формат выгрузки (ГГГГ-ММ-ДД, в том числе со временем) разбирает fromisoformat на C,
+        strptime вызывается только для остальных форматов """
+    if '.' not in text:
+        try:
+            return datetime.fromisoformat(text).date()
+        except ValueError:
+            pass
     for fmt in fmts:
         try:
-            dt = datetime.strptime(text, fmt)
-            return dt.date()
+            return datetime.strptime(text, fmt).date()
         except ValueError:
             continue
-    logger.warning(f"Не удалось распознать дату: {element.text}")
+    logger.warning('Не удалось распознать дату: %s', element.text)
     return None
     
 def safe_bool(element):
-    if element is None or element.text is None:
+    if element is None:
         return None
-    text = element.text.strip()
+    text = element.text
+    """ В выгрузке флаги почти всегда записаны ровно как '0' или '1', strip нужен только для остальных случаев """
+    if text == '1':
+        return True
+    if text == '0':
+        return False
+    if text is None:
+        return None
+    text = text.strip()
     if text == '1':
         return True
     elif text == '0':
         return False
     return None
 
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+ARCHIVE_SPOOL_SIZE = 256 << 20  # Архив до 256 MiB держим в памяти, больший сбрасывается во временный файл
+
 def download_and_extract_archive(url):
-    """Загрузка и распаковка архива с данными"""
+    """Загрузка и распаковка архива с данными. Возвращает список XML файлов и валидаторы ответа (ETag, Last-Modified)
+    или None, если архив не изменился"""
     try:
         logger.info(f"Загрузка данных с {url}")
-        response = requests.get(url, stream=True)
+        """ Условный запрос: если архив не менялся, сервер ответит 304 и скачивать ничего не придётся """
+        state = load_state()
+        headers = {}
+        if state.get('__etag'):
+            headers['If-None-Match'] = state['__etag']
+        if state.get('__last_modified'):
+            headers['If-Modified-Since'] = state['__last_modified']
+        response = requests.get(url, headers=headers, stream=True)
+        if response.status_code == 304:
+            logger.info("Архив на сервере не изменился (304 Not Modified)")
+            return None
         response.raise_for_status()
         
         """ Создание папку для кэша, если ее нет """
         os.makedirs(CONFIG['cache_dir'], exist_ok=True)
         
-        """ Сохранение архива """
-        zip_path = os.path.join(CONFIG['cache_dir'], 'data.zip')
-        with open(zip_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        """ Распаковка архива """
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(CONFIG['cache_dir'])
-            extracted_files = zip_ref.namelist()
+        """ Архив не сохраняется в кэш: поток ответа копируется блоками по 1 MiB в буфер,
+            который остаётся в памяти, пока не превысит ARCHIVE_SPOOL_SIZE """
+        response.raw.decode_content = True
+        with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE) as archive:
+            shutil.copyfileobj(response.raw, archive, DOWNLOAD_CHUNK_SIZE)
+            archive.seek(0)
+            
+            """ Распаковка архива: извлекаем только XML, остальные файлы парсеру не нужны """
+            with zipfile.ZipFile(archive, 'r') as zip_ref:
+                extracted_files = [name for name in zip_ref.namelist() if name.endswith('.xml')]
+                for name in extracted_files:
+                    zip_ref.extract(name, CONFIG['cache_dir'])
         
         logger.info(f"Архив успешно распакован. Файлы: {extracted_files}")
-        return extracted_files
+        
+        """ Валидаторы сохраняются в состояние только после успешной загрузки в БД (см. save_validators) """
+        validators = {
+            '__etag': response.headers.get('ETag'),
+            '__last_modified': response.headers.get('Last-Modified')
+        }
+        return extracted_files, validators
         
     except Exception as e:
         logger.error(f"Ошибка при загрузке/распаковке архива: {str(e)}")
         raise
 
+HASH_CHUNK_SIZE = 1 << 20  # 1 MiB
+
 def get_file_hash(file_path):
     """Вычисление хеша файла для проверки изменений"""
-    hasher = hashlib.md5()
     with open(file_path, 'rb') as f:
-        buf = f.read()
-        hasher.update(buf)
+        """ Файл читается блоками, поэтому в памяти никогда не держится целиком """
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'blake2b').hexdigest()
+        hasher = hashlib.blake2b()
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
     return hasher.hexdigest()
 
 def check_for_updates(file_path):
     """Проверка изменений в файле"""
     state = load_state()
-    current_hash = get_file_hash(file_path)
-    
-    if file_path in state and state[file_path] == current_hash:
+    stat = os.stat(file_path)
+    previous = state.get(file_path) or {}
+    if isinstance(previous, str):
+        previous = {'hash': previous}  # Состояние в старом формате хранило только хеш
+    
+    """ Совпали размер и время изменения — файл тот же; другой размер — файл точно изменился.
+        Хешировать приходится только при равном размере и другом времени изменения """
+    if previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
         logger.info("Файл не изменился с момента последней обработки")
         return False
     
-    state[file_path] = current_hash
+    current_hash = None
+    if previous.get('size', stat.st_size) == stat.st_size:
+        current_hash = get_file_hash(file_path)
+        if previous.get('hash') == current_hash:
+            logger.info("Файл не изменился с момента последней обработки")
+            state[file_path] = {'hash': current_hash, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            save_state(state)
+            return False
+    
+    state[file_path] = {'hash': current_hash, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
     save_state(state)
     logger.info("Обнаружены изменения в файле или файл новый")
     return True
@@ -214,225 +337,375 @@ def save_state(state):
     except Exception as e:
         logger.error(f"Ошибка сохранения состояния: {str(e)}")
         
+def save_validators(validators):
+    """Сохранение ETag/Last-Modified для следующего условного запроса"""
+    state = load_state()
+    state.update(validators)
+    save_state(state)
+        
 def find_xml_file(directory):
     """Поиск XML файла в директории"""
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.xml'):
-                return os.path.join(root, file)
+    """ scandir отдаёт тип записи без лишних stat и позволяет остановиться на первом XML.
+        Как и в os.walk, файлы текущей папки проверяются раньше вложенных папок """
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.endswith('.xml') and entry.is_file():
+                return entry.path
+    for subdir in subdirs:
+        found = find_xml_file(subdir)
+        if found:
+            return found
     return None
 
+def iter_certificates(xml_file):
+    """ Потоково перебирает элементы Certificate, освобождая память после обработки каждого """
+    if LXML:
+        """ huge_tree снимает ограничения libxml2 на размер текстовых узлов, иначе полная выгрузка может не разобраться """
+        for _, elem in ET.iterparse(xml_file, events=('end',), tag='{*}Certificate',
+                                       remove_comments=True, remove_pis=True, huge_tree=True):
+            yield elem
+            """ Удаляем уже обработанные элементы, иначе lxml держит их в дереве до конца разбора """
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    else:
+        """ Имя тега без пространства имён берём из кэша LOCAL_TAGS: один поиск в словаре на элемент,
+            и, как фильтр '{*}Certificate' в lxml, проверка не зависит от пространства имён """
+        local_tags = LOCAL_TAGS
+        for _, elem in ET.iterparse(xml_file, events=('end',)):
+            if local_tags[elem.tag] == 'Certificate':
+                yield elem
+                elem.clear()
+
+""" Программы лежат на фиксированной глубине: Certificate/Supplements/Supplement/EducationalPrograms.
+    Прямой путь не обходит всё поддерево, а в lxml ещё и компилируется в XPath один раз """
+PROGRAMS_PATH = 'Supplements/Supplement/EducationalPrograms/EducationalProgram'
+if LXML:
+    find_programs = ET.XPath(PROGRAMS_PATH)
+else:
+    def find_programs(cert_elem):
+        return cert_elem.findall(PROGRAMS_PATH)
+
+def insert_sql(table, columns):
+    """ Текст INSERT с позиционными параметрами для драйвера sqlite3 """
+    names = ', '.join(f'"{name}"' for name in columns)
+    placeholders = ', '.join('?' * len(columns))
+    return f'INSERT INTO {table.name} ({names}) VALUES ({placeholders})'
+
+def flush_rows(session, org_rows, prog_rows):
+    """ Записывает накопленные строки пачкой и очищает буферы.
+        Строки уходят прямо в executemany драйвера sqlite3 внутри транзакции сессии, минуя обработку параметров SQLAlchemy """
+    connection = session.connection()
+    for table, rows in ((Organization.__table__, org_rows), (EducationalProgram.__table__, prog_rows)):
+        if rows:
+            columns = tuple(rows[0])
+            connection.exec_driver_sql(insert_sql(table, columns), list(map(itemgetter(*columns), rows)))
+            rows.clear()
+
+def write_batches(session, batches, errors):
+    """ Поток записи: забирает пачки из очереди, пока не придёт None.
+        После ошибки очередь продолжает вычитываться, чтобы поток разбора не завис на put """
+    while (batch := batches.get()) is not None:
+        if errors:
+            continue
+        try:
+            flush_rows(session, *batch)
+        except Exception as e:
+            errors.append(e)
+
 def parse_xml_to_db(xml_file, session):
-    """ Парсер XML """
+    """ Парсер XML. Возвращает статистику загруженных строк или None при ошибке """
     try:
-        """ Кэшируем типы организаций """
-        org_types_cache = {ot.code: ot for ot in session.query(OrganizationType).all()}
-        
-        file_size = os.path.getsize(xml_file) / (1024 * 1024)
-        logger.info(f'Начало обработки файла {xml_file} (размер: {file_size:.2f} MB)')
-        
-        for event, elem in ET.iterparse(xml_file, events=('end',)):
-            if elem.tag.endswith('Certificate'):
-                try:
-                    """ Cобираем программы для передачи в process_organization """
-                    programs = []
-                    for supp_elem in elem.findall('.//Supplement'):
-                        for prog_elem in supp_elem.findall('.//EducationalProgram'):
-                            programs.append(prog_elem)
-                
-                    org = process_organization(elem, session, org_types_cache, programs)
-                    if org is None:
-                        continue
-                    
-                    if org.org_type is None:
-                        logger.warning(f'Организация {org.EduOrgFullName} не имеет типа. Пропуск.')
-                        continue
-                    
-                    if org.org_type.code != 'higher' and not org.IsBranch:
-                        logger.debug(f'Пропуск организации {org.EduOrgFullName}, TypeName: {org.TypeName}, IsBranch: {org.IsBranch}, org_type.code: {org.org_type.code}')
-                        continue
+        """ Весь разбор файла выполняется в одной транзакции """
+        with session.begin():
+            """ Кэшируем типы организаций """
+            org_types_cache = {ot.code: ot for ot in session.query(OrganizationType).all()}
+            higher_type_id = org_types_cache['higher'].id
+            
+            """ Справочники уровней и форм обучения загружаем один раз, а не запросом на каждую программу.
+                Сортировка по убыванию id оставляет в словаре первую запись, как это делал .first() """
+            level_ids = {level.code: level.id for level in session.query(EducationLevel).order_by(EducationLevel.id.desc())}
+            form_ids = {form.code: form.id for form in session.query(EducationForm).order_by(EducationForm.id.desc())}
+            
+            """ Первичные ключи организаций назначаем сами, чтобы программы могли ссылаться на них до вставки """
+            next_org_id = (session.query(func.max(Organization.id)).scalar() or 0) + 1
+            batch_size = CONFIG['batch_size']
+            org_rows = []
+            prog_rows = []
+            processed = 0
+            """ Статистику считаем по ходу разбора, а не запросами COUNT(*) после загрузки """
+            stats = {'organizations': 0, 'main_universities': 0, 'branches': 0, 'programs': 0}
+            
+            """ Головную организацию филиала ищем по словарю {id или ИНН: id} вместо запроса к БД.
+                Филиалы, чья головная организация встретится позже, досвязываются после разбора """
+            parent_index = {}
+            unresolved_branches = []
+            
+            """ SQLite допускает одного писателя, поэтому поток записи один; драйвер отпускает GIL
+                на время выполнения запросов, и разбор следующей пачки идёт параллельно с записью """
+            writer = None
+            if CONFIG.get('threaded', True):
+                batches = queue.Queue(maxsize=CONFIG.get('queue_size', 4))
+                writer_errors = []
+                writer = threading.Thread(target=write_batches, args=(session, batches, writer_errors),
+                                          name='db-writer', daemon=True)
+                writer.start()
+            
+            file_size = os.path.getsize(xml_file) / (1024 * 1024)
+            logger.info(f'Начало обработки файла {xml_file} (размер: {file_size:.2f} MB)')
+            
+            try:
+                for elem in iter_certificates(xml_file):
+                    processed += 1
+                    try:
+                        """ Свидетельство без организации пропускаем до поиска его программ """
+                        org_elem = elem.find('ActualEducationOrganization')
+                        if org_elem is None:
+                            logger.warning('Не найден элемент ActualEducationOrganization')
+                            continue
+                        
+                        """ Cобираем программы один раз: они нужны и для классификации организации, и для вставки """
+                        programs = find_programs(elem)
+                        org = process_organization(org_elem, org_types_cache, programs)
+                        if org is None:
+                            continue
                     
-                    session.add(org)
-                    session.flush()
+                        if org['type_id'] != higher_type_id and not org['IsBranch']:
+                            logger.debug('Пропуск организации %s, TypeName: %s, IsBranch: %s, type_id: %s',
+                                         org['EduOrgFullName'], org['TypeName'], org['IsBranch'], org['type_id'])
+                            continue
                     
-                    """ Обработка филиалов """
-                    if org.IsBranch:
-                        parent = session.query(Organization).filter(
-                            (Organization.id == org.HeadEduOrgId) |
-                            (Organization.INN == org.HeadEduOrgId)
-                        ).first()
-                        if parent:
-                            org.parent_id = parent.id
-
-                    # Обработка программ
-                    for supp_elem in elem.findall('.//Supplement'):
-                        for prog_elem in supp_elem.findall('.//EducationalProgram'):
-                            program = process_program(prog_elem, session)
-                            program.organization_id = org.id
-                            session.add(program)
+                        org['id'] = next_org_id
+                        next_org_id += 1
+                        parent_index[str(org['id'])] = org['id']
+                        if org['INN']:
+                            parent_index.setdefault(org['INN'], org['id'])
+                        org['parent_id'] = None
+                        if org['IsBranch'] and org['HeadEduOrgId']:
+                            org['parent_id'] = parent_index.get(org['HeadEduOrgId'])
+                            if org['parent_id'] is None:
+                                unresolved_branches.append((org['id'], org['HeadEduOrgId']))
+                        org_rows.append(org)
+                        stats['organizations'] += 1
+                        if org['IsBranch']:
+                            stats['branches'] += 1
+                        elif org['IsBranch'] is False and org['type_id'] == higher_type_id:
+                            stats['main_universities'] += 1
                     
-                    if len(session.new) % 100 == 0:
-                        session.commit()
+                        # Обработка программ
+                        for prog_elem in programs:
+                            program = process_program(prog_elem, level_ids, form_ids)
+                            program['organization_id'] = org['id']
+                            prog_rows.append(program)
+                            stats['programs'] += 1
                         
-                except Exception as e:
-                    logger.error(f'Ошибка обработки сертификата: {str(e)}')
-                    session.rollback()
+                    except Exception as e:
+                        logger.error('Ошибка обработки сертификата: %s', e)
+                    
+                    """ Запись пачки вне обработки отдельного сертификата: ошибка БД прерывает весь разбор """
+                    if len(org_rows) >= batch_size or len(prog_rows) >= batch_size:
+                        if writer:
+                            if writer_errors:
+                                break
+                            batches.put((org_rows, prog_rows))
+                            org_rows, prog_rows = [], []
+                        else:
+                            flush_rows(session, org_rows, prog_rows)
+                        logger.info('Обработано %d сертификатов...', processed)
                 
-                elem.clear()
-        
-        session.commit()
+                if writer:
+                    if not writer_errors:
+                        batches.put((org_rows, prog_rows))
+                else:
+                    flush_rows(session, org_rows, prog_rows)
+            finally:
+                """ Поток записи останавливаем и при ошибке разбора, чтобы он не трогал сессию во время отката """
+                if writer:
+                    batches.put(None)
+                    writer.join()
+            
+            if writer and writer_errors:
+                raise writer_errors[0]
+            
+            """ Обработка филиалов, головная организация которых шла в файле позже филиала """
+            orgs = Organization.__table__
+            late_parents = []
+            still_unresolved = False
+            for branch_id, head in unresolved_branches:
+                parent_id = parent_index.get(head)
+                if parent_id is None:
+                    still_unresolved = True
+                else:
+                    late_parents.append({'branch_id': branch_id, 'head_id': parent_id})
+            if late_parents:
+                session.execute(
+                    update(orgs).where(orgs.c.id == bindparam('branch_id')).values(parent_id=bindparam('head_id')),
+                    late_parents
+                )
+            
+            """ Оставшиеся филиалы могут ссылаться на организации из предыдущих загрузок: их связываем одним UPDATE """
+            if still_unresolved:
+                parent = orgs.alias('parent')
+                session.execute(
+                    update(orgs)
+                    .where(orgs.c.IsBranch == True, orgs.c.parent_id.is_(None))
+                    .values(parent_id=select(parent.c.id).where(
+                        (parent.c.id == orgs.c.HeadEduOrgId) |
+                        (parent.c.INN == orgs.c.HeadEduOrgId)
+                    ).limit(1).scalar_subquery())
+                )
         
         """ Логируем статистику """
-        main_universities = session.query(Organization).filter(
-            Organization.type_id == session.query(OrganizationType).filter_by(code='higher').first().id,
-            Organization.IsBranch == False
-        ).count()
-        branches = session.query(Organization).filter(Organization.IsBranch == True).count()
-        logger.info(f'Количество основных вузов: {main_universities}')
-        logger.info(f'Количество филиалов: {branches}')
+        logger.info(f'Количество основных вузов: {stats["main_universities"]}')
+        logger.info(f'Количество филиалов: {stats["branches"]}')
         
-        return True
+        return stats
         
     except Exception as e:
         logger.error(f'Критическая ошибка: {str(e)}')
         session.rollback()
-        return False
+        return None
         
     except Exception as e:
         logger.error(f'Критическая ошибка: {str(e)}')
         session.rollback()
-        return False
-
-def process_organization(cert_elem, session, org_types_cache, programs=None):
-    """ Извлекает данные об образовательной организации из XML и создаёт объект Organization. """
-    org_elem = cert_elem.find('ActualEducationOrganization')
-    if org_elem is None:
-        logger.warning('Не найден элемент ActualEducationOrganization')
         return None
-    
-    type_elem = org_elem.find('TypeName')
-    type_name = safe_text(type_elem, '').lower()
-    is_branch = safe_bool(org_elem.find('IsBranch'))
-    
-    logger.debug(f'Обработка организации: {safe_text(org_elem.find('FullName'))}, TypeName: {type_name}, IsBranch: {is_branch}')
+
+""" Ключевые слова для классификации собираются в регулярные выражения один раз при загрузке модуля """
+SCHOOL_RE = re.compile('|'.join([
+    'школа', 'лицей', 'гимназия', 'среднее общеобразовательное', 'средняя общеобразовательная'
+]))
+HIGHER_RE = re.compile('|'.join([
+    'вуз', 'университет', 'институт', 'высшее учебное заведение', 'академия',
+    'федеральное государственное', 'государственное образовательное',
+    'национальный исследовательский', 'технологический университет',
+    'высшее образование', 'бюджетное образовательное учреждение',
+    'автономное образовательное учреждение', 'государственный университет'
+]))
+HIGHER_LEVEL_RE = re.compile('бакалавриат|магистратура|специалитет|аспирантура')
+SECONDARY_PRO_RE = re.compile('колледж|техникум')
+
+""" Соответствие найденной подстроки коду справочника. Уровни проверяются по порядку, как в цепочке if/elif:
+    код определяет первое ключевое слово из списка, а не самое левое в строке """
+LEVEL_CODES = {
+    'бакалавр': 'bachelor',
+    'магистр': 'master',
+    'специалист': 'specialist',
+    'аспирант': 'specialist'
+}
+
+FORM_CODES = {
+    'очно-заочная': 'mixed',
+    'заочная': 'part_time',
+    'очная': 'full_time',
+    'вечерняя': 'mixed'
+}
+FORM_RE = re.compile('|'.join(FORM_CODES))
+
+""" Различных названий уровней и форм обучения в выгрузке единицы, поэтому классификация
+    выполняется один раз на каждое уникальное значение, а не на каждую программу """
+@lru_cache(maxsize=1024)
+def level_code_for(level_name):
+    level_name = level_name.lower()
+    for keyword, code in LEVEL_CODES.items():
+        if keyword in level_name:
+            return code
+    return None
+
+@lru_cache(maxsize=1024)
+def form_code_for(form_name):
+    form_match = FORM_RE.search(form_name.lower())
+    return FORM_CODES[form_match.group()] if form_match else 'full_time'  # Значение по умолчанию
+
+def process_organization(org_elem, org_types_cache, programs=None):
+    """ Извлекает данные из элемента ActualEducationOrganization и возвращает строку для таблицы organizations. """
+    fields = children_by_tag(org_elem)
+    type_elem = fields.get('TypeName')
+    type_name = shared(safe_text(type_elem, '').lower())
+    is_branch = safe_bool(fields.get('IsBranch'))
+    
+    """ Аргументы отладочных сообщений передаются отдельно от шаблона: строка собирается, только если DEBUG включён """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Обработка организации: %s, TypeName: %s, IsBranch: %s', safe_text(fields.get('FullName')), type_name, is_branch)
 
     org_type_code = None
     
     """ Явно исключаем школы """
-    if any(x in type_name for x in ['школа', 'лицей', 'гимназия', 'среднее общеобразовательное', 'средняя общеобразовательная']):
+    if SCHOOL_RE.search(type_name):
         org_type_code = 'secondary'
-        logger.debug(f'Организация классифицирована как школа: {type_name}')
-    
-    elif any(x in type_name for x in [
-        'вуз', 'университет', 'институт', 'высшее учебное заведение', 'академия',
-        'федеральное государственное', 'государственное образовательное',
-        'национальный исследовательский', 'технологический университет',
-        'высшее образование', 'бюджетное образовательное учреждение',
-        'автономное образовательное учреждение', 'государственный университет'
-    ]):
+        logger.debug('Организация классифицирована как школа: %s', type_name)
+    
+    elif HIGHER_RE.search(type_name):
         org_type_code = 'higher'
     
     elif programs:
         for prog_elem in programs:
             edu_level = safe_text(prog_elem.find('EduLevelName'), '').lower()
-            if any(x in edu_level for x in ['бакалавриат', 'магистратура', 'специалитет', 'аспирантура']):
+            if HIGHER_LEVEL_RE.search(edu_level):
                 org_type_code = 'higher'
-                logger.debug(f'Организация классифицирована как вуз на основе программы: {edu_level}')
+                logger.debug('Организация классифицирована как вуз на основе программы: %s', edu_level)
                 break
     
     if not org_type_code:
-        org_type_code = 'secondary_pro' if 'колледж' in type_name or 'техникум' in type_name else 'secondary'
-        logger.debug(f"Неизвестный тип организации: {type_name}, установлен по умолчанию: {org_type_code}")
+        org_type_code = 'secondary_pro' if SECONDARY_PRO_RE.search(type_name) else 'secondary'
+        logger.debug('Неизвестный тип организации: %s, установлен по умолчанию: %s', type_name, org_type_code)
     
     """ Получаем объект OrganizationType из кэша """
     org_type_obj = org_types_cache.get(org_type_code)
     if not org_type_obj:
-        logger.warning(f"Тип организации '{org_type_code}' не найден в базе")
+        logger.warning("Тип организации '%s' не найден в базе", org_type_code)
         return None
 
-    org = Organization(
-        EduOrgShortName=safe_text(org_elem.find('ShortName')),
-        EduOrgFullName=safe_text(org_elem.find('FullName')),
-        Phone=safe_text(org_elem.find('Phone')),
-        Fax=safe_text(org_elem.find('Fax')),
-        Email=safe_text(org_elem.find('Email')),
-        WebSite=safe_text(org_elem.find('WebSite')),
-        PostAddress=safe_text(org_elem.find('PostAddress')),
-        INN=safe_text(org_elem.find('INN')),
-        KPP=safe_text(org_elem.find('KPP')),
-        OGRN=safe_text(org_elem.find('OGRN')),
-        HeadPost=safe_text(org_elem.find('HeadPost')),
-        HeadName=safe_text(org_elem.find('HeadName')),
-        FormName=safe_text(org_elem.find('FormName')),
-        KindName=safe_text(org_elem.find('KindName')),
+    return dict(
+        EduOrgShortName=safe_text(fields.get('ShortName')),
+        EduOrgFullName=safe_text(fields.get('FullName')),
+        Phone=safe_text(fields.get('Phone')),
+        Fax=safe_text(fields.get('Fax')),
+        Email=safe_text(fields.get('Email')),
+        WebSite=safe_text(fields.get('WebSite')),
+        PostAddress=safe_text(fields.get('PostAddress')),
+        INN=safe_text(fields.get('INN')),
+        KPP=safe_text(fields.get('KPP')),
+        OGRN=safe_text(fields.get('OGRN')),
+        HeadPost=safe_text(fields.get('HeadPost')),
+        HeadName=safe_text(fields.get('HeadName')),
+        FormName=shared(safe_text(fields.get('FormName'))),
+        KindName=shared(safe_text(fields.get('KindName'))),
         TypeName=type_name,
-        RegionName=safe_text(org_elem.find('RegionName')),
-        FederalDistrictName=safe_text(org_elem.find('FederalDistrictName')),
-        FederalDistrictShortName=safe_text(org_elem.find('FederalDistrictShortName')),
+        RegionName=shared(safe_text(fields.get('RegionName'))),
+        FederalDistrictName=shared(safe_text(fields.get('FederalDistrictName'))),
+        FederalDistrictShortName=shared(safe_text(fields.get('FederalDistrictShortName'))),
         IsBranch=is_branch,
-        HeadEduOrgId=safe_text(org_elem.find('HeadEduOrgId')),
+        HeadEduOrgId=safe_text(fields.get('HeadEduOrgId')),
         type_id=org_type_obj.id
     )
     
-    """ Устанавливаем объект OrganizationType для связи """
-    org.org_type = org_type_obj
-    
-    return org
     
-    
-def process_program(prog_elem, session):
+def process_program(prog_elem, level_ids, form_ids):
     """ Извлекает данные об образовательных программах """
-    level_name = safe_text(prog_elem.find('EduLevelName'), '').lower()
-    form_name = safe_text(prog_elem.find('EducationForm'), '').lower()
-    level_code = None
-    if 'бакалавр' in level_name:
-        level_code = 'bachelor'
-    elif 'магистр' in level_name:
-        level_code = 'master'
-    elif 'специалист' in level_name or 'аспирант' in level_name:
-        level_code = 'specialist'
-    
-    form_name = safe_text(prog_elem.find('EducationForm'), '').lower()
-    form_code = None
-    
-    if 'очная' in form_name:
-        form_code = 'full_time'
-    elif 'заочная' in form_name:
-        form_code = 'part_time'
-    elif 'очно-заочная' in form_name or 'вечерняя' in form_name:
-        form_code = 'mixed'
-    else:
-        form_code = 'full_time'  # Значение по умолчанию
-
-    level_id = None
-    if level_code:
-        level = session.query(EducationLevel).filter_by(code=level_code).first()
-        if level:
-            level_id = level.id
-            
-    form_id = None
-    if form_code:
-        form = session.query(EducationForm).filter_by(code=form_code).first()
-        if form:
-            form_id = form.id
-    
-    program = EducationalProgram (
-        TypeName=safe_text(prog_elem.find('TypeName')),
-        EduLevelName=safe_text(prog_elem.find('EduLevelName')),
-        ProgrammName=safe_text(prog_elem.find('ProgrammName')),
-        UGSName=safe_text(prog_elem.find('UGSName')),
-        UGSCode=safe_text(prog_elem.find('UGSCode')),
-        EduNormativePeriod=safe_text(prog_elem.find('EduNormativePeriod')),
-        Qualification=safe_text(prog_elem.find('Qualification')),
-        IsAccredited=safe_bool(prog_elem.find('IsAccredited')),
-        IsCanceled=safe_bool(prog_elem.find('IsCanceled')),
-        IsSuspended=safe_bool(prog_elem.find('IsSuspended')),
-        okso_code=safe_text(prog_elem.find('ProgrammCode')),
+    fields = children_by_tag(prog_elem)
+    level_name = shared(safe_text(fields.get('EduLevelName')))
+    level_id = level_ids.get(level_code_for(level_name))
+    form_id = form_ids.get(form_code_for(safe_text(fields.get('EducationForm'))))
+    
+    return dict(
+        TypeName=shared(safe_text(fields.get('TypeName'))),
+        EduLevelName=level_name,
+        ProgrammName=safe_text(fields.get('ProgrammName')),
+        UGSName=shared(safe_text(fields.get('UGSName'))),
+        UGSCode=shared(safe_text(fields.get('UGSCode'))),
+        EduNormativePeriod=shared(safe_text(fields.get('EduNormativePeriod'))),
+        Qualification=shared(safe_text(fields.get('Qualification'))),
+        IsAccredited=safe_bool(fields.get('IsAccredited')),
+        IsCanceled=safe_bool(fields.get('IsCanceled')),
+        IsSuspended=safe_bool(fields.get('IsSuspended')),
+        okso_code=safe_text(fields.get('ProgrammCode')),
         level_id=level_id,
         form_id=form_id
     )
-    
-    return program
 
 
 def initialize_database(session):
@@ -460,25 +733,25 @@ def initialize_database(session):
         {'name': 'Дистанционная', 'code': 'remote'}
     ]
     
-    for item in org_types:
-        session.merge(OrganizationType(**item))
-    
-    for item in edu_levels:
-        session.merge(EducationLevel(**item))
-    
-    for item in edu_forms:
-        session.merge(EducationForm(**item))
+    """ Каждый справочник пишется одним INSERT ... ON CONFLICT DO NOTHING: уже существующие коды пропускаются """
+    for model, rows in ((OrganizationType, org_types), (EducationLevel, edu_levels), (EducationForm, edu_forms)):
+        session.execute(sqlite_insert(model.__table__).values(rows).on_conflict_do_nothing())
     
     session.commit()
 
 def main():
     """ Загрузка и распаковка архива """
     try:
-        extracted_files = download_and_extract_archive(CONFIG['data_url'])
+        download = download_and_extract_archive(CONFIG['data_url'])
     except Exception as e:
         logger.error(f'Не удалось загрузить данные: {str(e)}')
         return
     
+    if download is None:
+        logger.info('Данные не изменились, обработка не требуется')
+        return
+    extracted_files, validators = download
+    
     """ Поиск XML файла в распакованных данных """
     xml_file = find_xml_file(CONFIG['cache_dir'])
     if not xml_file:
@@ -488,12 +761,18 @@ def main():
     """ Проверка изменений """
     if not check_for_updates(xml_file):
         logger.info('Данные не изменились, обработка не требуется')
+        """ Содержимое уже загружено ранее, поэтому этот архив можно считать обработанным """
+        save_validators(validators)
         return
     
     """ Инициализация БД """
     engine = create_engine(f'sqlite:///{CONFIG['db_file']}', echo=False)
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+    event.listen(engine, 'begin', begin_sqlite_transaction)
     Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
+    """ Загрузка идёт пачками через executemany, поэтому автосброс и сброс состояния объектов
+        после commit только тратят время на обход identity map """
+    Session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
     session = Session()
     
     try:
@@ -503,18 +782,15 @@ def main():
         logger.info('Начало загрузки данных...')
         start_time = datetime.now()
         
-        if parse_xml_to_db(xml_file, session):
+        stats = parse_xml_to_db(xml_file, session)
+        if stats is not None:
             duration = datetime.now() - start_time
-            stats = {
-                'organizations': session.query(Organization).count(),
-                'programs': session.query(EducationalProgram).count(),
-                'branches': session.query(Organization).filter(Organization.IsBranch==True).count(),
-                'duration_seconds': duration.total_seconds()
-            }
+            stats['duration_seconds'] = duration.total_seconds()
+            save_validators(validators)
             logger.info(f'''
                 Загрузка завершена успешно!
                 Статистика:
-                - Всего организаций: {stats['organizations']}
+                - Загружено организаций: {stats['organizations']}
                 - Из них филиалов: {stats['branches']}
                 - Образовательных программ: {stats['programs']}
                 - Время выполнения: {stats['duration_seconds']:.2f} сек